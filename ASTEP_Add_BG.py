@@ -1,51 +1,76 @@
 import numpy as np
 import h5py as h5
+import os
+
+from ASTEP_BG_Store import ASTEP_BG_Store
 
 """
 This function applies the reverse calibration to A-STEP simulations.
 
 Steps
     1: Define file names and parameters
-    2: Read .csv background file
+    2: Read .csv background file (or open its time-indexed store, if looping)
     3: Clean FPGA timestamps
-    4: Combine background array & simulated source array
+    4: Combine background array & simulated source array, either truncating at the earlier of
+       the ends of each array, or looping the background to cover the whole source array
     5: Sort by FPGA timestamp
     6: Write to output file
 
 """
 
 class ASTEP_Add_BG:
-    def __init__(self,ARC,BG_name,is_h5):
+    def __init__(self,ARC,BG_name,is_h5,is_cols=False,loop_BG=False,BG_store_name=''):
         self.ARC        = ARC
         self.BG_name    = BG_name
         self.is_h5      = is_h5
+        self.is_cols    = is_cols
+        self.loop_BG    = loop_BG
+        
+        if loop_BG:
+            self.BG_store = ASTEP_BG_Store(ARC,BG_name,self.parse_line,BG_store_name)
         
         if is_h5:
             self.out_name = ARC.sim_name + '.ASTEP_wBG.h5'
+        elif is_cols:
+            self.out_name = ARC.sim_name + '.ASTEP_wBG.cols'
         else:
             self.out_name = ARC.sim_name + '.ASTEP_wBG.csv'
                 
+    def parse_line(self,line):
+        # Parses one line of the background file, mapping the isCol entry to 0/1
+        split_line = line.split(',')
+        if (split_line[6].strip() == 'True') or (split_line[6].strip() == '1'):
+            split_line[6] = '1'
+        elif (split_line[6].strip() == 'False') or (split_line[6].strip() == '0'):
+            split_line[6] = '0'
+        else:
+            print('Bad is_col entry')
+        return split_line
+    
     def read_BG(self):
-        # Read in BG file
-        output = []
-        first_line = True
-        for line in open(self.BG_name, 'r'):
-            if not first_line:
-                split_line = line.split(',')
-                if (split_line[6].strip() == 'True') or (split_line[6].strip() == '1'):
-                    split_line[6] = '1'
-                elif (split_line[6].strip() == 'False') or (split_line[6].strip() == '0'):
-                    split_line[6] = '0'
-                else:
-                    print('Bad is_col entry')
-                
-                output.append(split_line)
-            first_line = False
-        output = np.array(output,dtype = float)
-        output = output[output[:,4] == 4] # filter on payload == 4
-        self.BG_array = output
+        if self.loop_BG:
+            # The background is read window by window from the store in sort_FPGA_times
+            self.BG_store.load()
+        else:
+            # Read in BG file
+            self.ARC.progress.start('read_BG',unit = 'lines',total_bytes = os.path.getsize(self.BG_name))
+            n_bytes = 0
+            
+            output = []
+            first_line = True
+            for n_lines,line in enumerate(open(self.BG_name, 'r')):
+                n_bytes += len(line)
+                if n_lines % self.ARC.progress_stride == 0:
+                    self.ARC.progress.update(n_lines,n_bytes)
+                if not first_line:
+                    output.append(self.parse_line(line))
+                first_line = False
+            output = np.array(output,dtype = float)
+            self.ARC.progress.finish(len(output))
+            output = output[output[:,4] == 4] # filter on payload == 4
+            self.BG_array = output
     
-    def sort_FPGA_times(self):
+    def sort_BG_times(self):
         # Sort BG FGPA times
         self.BG_array = self.ARC.clean_FPGA_times(self.BG_array)
         
@@ -66,6 +91,8 @@ class ASTEP_Add_BG:
         
         self.BG_array[:,12] = (self.BG_FPGA_times_corrected%self.ARC.FPGA_Max_Clock)
         
+    def sort_source_times(self):
+        # Sort simulated source FPGA times
         self.ARC.out_array = self.ARC.clean_FPGA_times(self.ARC.out_array)
         
         out_FPGA_times = self.ARC.out_array[:,-1]
@@ -79,8 +106,23 @@ class ASTEP_Add_BG:
         self.out_FPGA_times_corrected = out_FPGA_times_corrected
         self.ARC.out_array[:,12] = (out_FPGA_times_corrected%self.ARC.FPGA_Max_Clock)
         
-        # Get maximum FPGA timestamp time
-        self.max_FPGA_time = min(max(self.BG_FPGA_times_corrected),max(self.out_FPGA_times_corrected).astype(int))
+    def sort_FPGA_times(self):
+        self.sort_source_times()
+        
+        if self.loop_BG:
+            # Keep every source hit, looping the background as many times as needed. The looped
+            # background for the whole source time range is held in memory at once.
+            self.max_FPGA_time = max(self.out_FPGA_times_corrected).astype(int) + 1
+            self.BG_array, self.BG_FPGA_times_corrected = self.BG_store.get_window(0,self.max_FPGA_time,loop = True)
+        else:
+            self.sort_BG_times()
+            
+            # Get maximum FPGA timestamp time
+            self.max_FPGA_time = min(max(self.BG_FPGA_times_corrected),max(self.out_FPGA_times_corrected).astype(int))
+            
+            if max(self.BG_FPGA_times_corrected) < max(self.out_FPGA_times_corrected):
+                n_dropped = sum(self.out_FPGA_times_corrected >= self.max_FPGA_time)
+                print(f'Background is shorter than the source: dropping {n_dropped} source hits. Use --loop_BG to keep them')
         
     def combine_arrays(self):
 
@@ -101,27 +143,21 @@ class ASTEP_Add_BG:
         combined_time_sorted = combined_times[sort_order]
 
         
-    def write_output(self):
+    def write_file(self,out_name):
         if self.is_h5:
-            out_file = h5.File(self.out_name,'w')
+            out_file = h5.File(out_name,'w')
             out_file.create_dataset('Data',data = self.combined_array_sorted)
             out_file.create_dataset('Column_Names',data = self.ARC.out_header.split(','))
             out_file.close()
         
+        elif self.is_cols:
+            self.ARC.write_columnar(out_name,self.combined_array_sorted,self.out_name)
+        
         else:
-            out_file = open(self.out_name,'w')
-            out_file.write(self.ARC.out_header + '\n')
-            for row in self.combined_array_sorted:
-                string = ""
-                for i,el in enumerate(row):
-                    if i == 11:
-                        string = string + f'{el:.2f},'
-                    elif i == 12:
-                        string = string + f'{int(el)}\n'
-                    else:
-                        string = string + f'{int(el)},'
-                out_file.write(string)
-            out_file.close()
+            self.ARC.write_csv(out_name,self.combined_array_sorted,self.out_name)
+    
+    def write_output(self):
+        self.ARC.write_atomic(self.out_name,self.write_file)
     
     def process(self):
         self.read_BG()
@@ -0,0 +1,245 @@
+import numpy as np
+import json
+import os
+import shutil
+import tempfile
+
+"""
+This function provides time-indexed access to an A-STEP background .csv file.
+
+Steps
+    1: Define file names and parameters
+    2: Read the .csv background file in chunks, cleaning and unwrapping the FPGA timestamps
+    3: Write the chunks to a columnar store, by default next to the .csv file (<.csv filename>.cols)
+    4: Index the store in blocks of rows by unwrapped FPGA time
+    5: Read any time window, optionally looping the background to cover arbitrarily long times
+
+The store uses the same layout as the -cols output (one <column>.bin per column and a
+header.json), with an extra fpga_unwrapped column holding the rollover-corrected FPGA time,
+zeroed at the first background hit. header.json also holds the block index and the period
+of the background. The store is rebuilt whenever the .csv file is newer than it. It is built
+in a temporary sibling directory and moved into place when complete, so jobs sharing one
+background never see a partially written store, and an existing store is never rewritten while
+another job may have it memory-mapped.
+
+Only the blocks overlapping a requested window are read, so the background outside that window
+is never loaded. The returned window itself is held in memory: with loop, a window covering a
+long simulation holds every tile of the background in it, so memory grows with the window
+length. Outlier removal with ARC.clean_FPGA_times is done per chunk, so an outlier sitting
+exactly on a chunk boundary may be kept.
+
+"""
+
+class ASTEP_BG_Store:
+    def __init__(self,ARC,BG_name,parse_line,store_name = '',block_size = 65536,chunk_size = 1000000):
+        self.ARC        = ARC
+        self.BG_name    = BG_name
+        self.parse_line = parse_line # parses one background .csv line into a list of fields
+        self.block_size = block_size
+        self.chunk_size = chunk_size
+
+        if store_name != '':
+            self.store_name = store_name
+        else:
+            self.store_name = BG_name + '.cols'
+        self.columns = ARC.out_header.split(',')
+
+    def read_chunks(self):
+        # Yields the background file in arrays of at most chunk_size rows, filtered on payload == 4
+        self.ARC.progress.start('build BG store',unit = 'lines',total_bytes = os.path.getsize(self.BG_name))
+        n_bytes = 0
+        
+        n_lines = 0
+        
+        output = []
+        first_line = True
+        for line in open(self.BG_name, 'r'):
+            n_bytes += len(line)
+            if n_lines % self.ARC.progress_stride == 0:
+                self.ARC.progress.update(n_lines,n_bytes)
+            n_lines += 1
+            if not first_line:
+                output.append(self.parse_line(line))
+                if len(output) == self.chunk_size:
+                    output = np.array(output,dtype = float)
+                    yield output[output[:,4] == 4]
+                    output = []
+            first_line = False
+        if len(output) > 0:
+            output = np.array(output,dtype = float)
+            yield output[output[:,4] == 4]
+        self.ARC.progress.finish(n_lines)
+
+    def is_current(self):
+        header_name = os.path.join(self.store_name,'header.json')
+        return os.path.exists(header_name) and (os.path.getmtime(self.BG_name) <= os.path.getmtime(header_name))
+
+    def build(self):
+        store_dir = os.path.dirname(os.path.abspath(self.store_name))
+        part_name = tempfile.mkdtemp(prefix = os.path.basename(self.store_name) + '.part.',dir = store_dir)
+        try:
+            self.build_into(part_name)
+        except BaseException:
+            shutil.rmtree(part_name)
+            raise
+
+        # Another job may have finished building the same store in the meantime
+        if self.is_current():
+            shutil.rmtree(part_name)
+            return
+
+        # A stale store is moved aside rather than rewritten, since other jobs may still have its
+        # files memory-mapped
+        old_name = ''
+        try:
+            if os.path.exists(self.store_name):
+                old_name = tempfile.mkdtemp(prefix = os.path.basename(self.store_name) + '.old.',dir = store_dir)
+                os.replace(self.store_name,os.path.join(old_name,'store'))
+            os.replace(part_name,self.store_name)
+        except OSError:
+            # Another job moved its store into place between the checks above and the replace
+            # (or moved the stale store aside first). Use its store if it is current.
+            shutil.rmtree(part_name)
+            if old_name != '':
+                shutil.rmtree(old_name)
+            if self.is_current():
+                return
+            raise
+        if old_name != '':
+            shutil.rmtree(old_name)
+
+    def build_into(self,store_name):
+        header_name = os.path.join(store_name,'header.json')
+
+        store_columns = self.columns + ['fpga_unwrapped']
+        dtypes = {col: self.ARC.column_dtype(col) for col in self.columns}
+        dtypes['fpga_unwrapped'] = np.dtype('<i8')
+        out_files = {col: open(os.path.join(store_name,col + '.bin'),'wb') for col in store_columns}
+
+        n_rows = 0
+        last_FPGA_time = None
+        n_rollovers = 0
+        first_FPGA_time = None
+
+        for chunk in self.read_chunks():
+            chunk = self.ARC.clean_FPGA_times(chunk)
+            if len(chunk) == 0:
+                continue
+
+            # Correct for rollover, carrying the last time of the previous chunk across the boundary
+            FPGA_times = chunk[:,12]
+            if last_FPGA_time is not None:
+                FPGA_times = np.concatenate(([last_FPGA_time],FPGA_times))
+            FPGA_time_diffs = np.diff(FPGA_times)
+            FPGA_time_diffs_rollovers = np.where(FPGA_time_diffs < (-self.ARC.FPGA_Max_Clock + self.ARC.FPGA_Rollover_Buffer))[0]+1
+
+            rollovers = np.zeros(len(FPGA_times))
+            rollovers[FPGA_time_diffs_rollovers] = 1
+            FPGA_times_corrected = FPGA_times + (n_rollovers + np.cumsum(rollovers))*self.ARC.FPGA_Max_Clock
+            if last_FPGA_time is not None:
+                FPGA_times_corrected = FPGA_times_corrected[1:]
+
+            last_FPGA_time = chunk[-1,12]
+            n_rollovers += len(FPGA_time_diffs_rollovers)
+
+            # Set clock to start at 0
+            if first_FPGA_time is None:
+                first_FPGA_time = FPGA_times_corrected[0]
+            FPGA_times_corrected = FPGA_times_corrected - first_FPGA_time
+
+            keep_BG_mask = (FPGA_times_corrected > 0)
+            chunk = chunk[keep_BG_mask]
+            FPGA_times_corrected = FPGA_times_corrected[keep_BG_mask]
+            chunk[:,12] = (FPGA_times_corrected%self.ARC.FPGA_Max_Clock)
+
+            for i,col in enumerate(self.columns):
+                np.ascontiguousarray(chunk[:,i],dtype = dtypes[col]).tofile(out_files[col])
+            np.ascontiguousarray(FPGA_times_corrected,dtype = dtypes['fpga_unwrapped']).tofile(out_files['fpga_unwrapped'])
+            n_rows += len(chunk)
+
+        for out_file in out_files.values():
+            out_file.close()
+
+        # Block index over unwrapped time. The times are not guaranteed to be sorted, so each
+        # block keeps both its earliest and latest time.
+        FPGA_times_corrected = np.memmap(os.path.join(store_name,'fpga_unwrapped.bin'),dtype = dtypes['fpga_unwrapped'],mode = 'r',shape = (n_rows,)) if n_rows > 0 else np.zeros(0)
+        block_min_time = []
+        block_max_time = []
+        for start in range(0,n_rows,self.block_size):
+            block = FPGA_times_corrected[start:start+self.block_size]
+            block_min_time.append(int(block.min()))
+            block_max_time.append(int(block.max()))
+        del FPGA_times_corrected
+
+        header = {'columns': store_columns,
+                  'dtypes': {col: dtypes[col].str for col in store_columns},
+                  'n_rows': n_rows,
+                  'block_size': self.block_size,
+                  'block_min_time': block_min_time,
+                  'block_max_time': block_max_time,
+                  'period': max(block_max_time) if n_rows > 0 else 0}
+        with open(header_name,'w') as header_file:
+            json.dump(header,header_file,indent = 4)
+
+    def load(self):
+        header_name = os.path.join(self.store_name,'header.json')
+        if not self.is_current():
+            self.build()
+
+        with open(header_name,'r') as header_file:
+            header = json.load(header_file)
+
+        self.n_rows = header['n_rows']
+        self.block_size = header['block_size']
+        self.block_min_time = np.array(header['block_min_time'])
+        self.block_max_time = np.array(header['block_max_time'])
+        self.period = header['period']
+
+        if self.n_rows == 0:
+            raise ValueError(f'No background hits in {self.BG_name}')
+
+        self.data = {}
+        for col in header['columns']:
+            self.data[col] = np.memmap(os.path.join(self.store_name,col + '.bin'),dtype = header['dtypes'][col],mode = 'r',shape = (self.n_rows,))
+
+    def read_window(self,t_start,t_end):
+        # Background hits with t_start <= unwrapped time < t_end, in file order
+        blocks = np.where((self.block_max_time >= t_start) & (self.block_min_time < t_end))[0]
+
+        BG_arrays = [np.zeros((0,len(self.columns)))]
+        BG_times = [np.zeros(0)]
+        for block in blocks:
+            start = block*self.block_size
+            end = min(start + self.block_size,self.n_rows)
+
+            block_times = self.data['fpga_unwrapped'][start:end]
+            mask = (block_times >= t_start) & (block_times < t_end)
+
+            BG_arrays.append(np.column_stack([self.data[col][start:end][mask] for col in self.columns]).astype(float))
+            BG_times.append(block_times[mask].astype(float))
+
+        return np.concatenate(BG_arrays), np.concatenate(BG_times)
+
+    def get_window(self,t_start,t_end,loop = False):
+
+        # Returns the background array and its unwrapped FPGA times for t_start <= time < t_end.
+        # With loop, the background is tiled end to end with period self.period, so that any window
+        # is covered. Tile k holds the background times shifted by k*period.
+
+        if not loop:
+            return self.read_window(t_start,t_end)
+
+        BG_arrays = [np.zeros((0,len(self.columns)))]
+        BG_times = [np.zeros(0)]
+
+        first_tile = max(int(np.ceil(t_start/self.period)) - 1,0)
+        last_tile = int(np.ceil(t_end/self.period)) - 1
+        for tile in range(first_tile,last_tile+1):
+            BG_array, BG_time = self.read_window(t_start - tile*self.period,t_end - tile*self.period)
+            BG_time = BG_time + tile*self.period
+            BG_array[:,12] = (BG_time%self.ARC.FPGA_Max_Clock)
+
+            BG_arrays.append(BG_array)
+            BG_times.append(BG_time)
+
+        return np.concatenate(BG_arrays), np.concatenate(BG_times)
@@ -14,9 +14,10 @@ Steps
 """
 
 class ASTEP_Effects:
-    def __init__(self,sim_name,in_array,is_h5,with_BG,ARC):
+    def __init__(self,sim_name,in_array,is_h5,with_BG,ARC,is_cols=False):
         self.sim_name   = sim_name
         self.is_h5      = is_h5
+        self.is_cols    = is_cols
         self.in_array   = in_array
         
         if is_h5:
@@ -24,6 +25,11 @@ class ASTEP_Effects:
                 self.out_name = sim_name + '.ASTEP_wBG_wEff.h5'
             else:
                 self.out_name = sim_name + '.ASTEP_wEff.h5'
+        elif is_cols:
+            if with_BG:
+                self.out_name = sim_name + '.ASTEP_wBG_wEff.cols'
+            else:
+                self.out_name = sim_name + '.ASTEP_wEff.cols'
         else:
             if with_BG:
                 self.out_name = sim_name + '.ASTEP_wBG_wEff.csv'
@@ -84,14 +90,26 @@ class ASTEP_Effects:
         self.out_array = self.in_array.copy()
         
         n_coin = sum(np.diff(self.out_time) < self.ARC.FPGA_readout_cycles)
+        n_coins = [n_coin]
         
         while n_coin != 0:
         
             print(f'Starting Coin Handling with N = {n_coin}')
+            
+            passes_remaining = self.ARC.progress.passes_remaining(n_coins)
+            if passes_remaining is None:
+                passes_remaining = '?'
+            extra = f'pass {len(n_coins)}, ~{passes_remaining} passes remaining'
+            self.ARC.progress.start(f'coincidence_hits pass {len(n_coins)}',total = len(self.out_time),unit = 'hits')
         
             start_idx = 0
             end_idx = 1
+            n_steps = 0
             while end_idx < len(self.out_time):
+                n_steps += 1
+                if n_steps % self.ARC.progress_stride == 0:
+                    self.ARC.progress.update(end_idx,extra = extra)
+                
                 # check that there is a coincidence
                 coinc = (self.out_time[end_idx] - self.out_time[start_idx]) < self.ARC.FPGA_readout_cycles
         
@@ -114,30 +132,27 @@ class ASTEP_Effects:
                 start_idx = end_idx
                 end_idx = start_idx + 1
                 
+            self.ARC.progress.finish(len(self.out_time))
+                
             # Check again
             n_coin = sum(np.diff(self.out_time) < self.ARC.FPGA_readout_cycles)
+            n_coins.append(n_coin)
         
-    def write_output(self):
+    def write_file(self,out_name):
         if self.is_h5:
-            out_file = h5.File(self.out_name,'w')
+            out_file = h5.File(out_name,'w')
             out_file.create_dataset('Data',data = self.out_array)
             out_file.create_dataset('Column_Names',data = self.ARC.out_header.split(','))
             out_file.close()
         
+        elif self.is_cols:
+            self.ARC.write_columnar(out_name,self.out_array,self.out_name)
+        
         else:
-            out_file = open(self.out_name,'w')
-            out_file.write(self.ARC.out_header + '\n')
-            for row in self.out_array:
-                string = ""
-                for i,el in enumerate(row):
-                    if i == 11:
-                        string = string + f'{el:.2f},'
-                    elif i == 12:
-                        string = string + f'{int(el)}\n'
-                    else:
-                        string = string + f'{int(el)},'
-                out_file.write(string)
-            out_file.close()
+            self.ARC.write_csv(out_name,self.out_array,self.out_name)
+    
+    def write_output(self):
+        self.ARC.write_atomic(self.out_name,self.write_file)
     
     def process(self):
         self.sort_FPGA_timestamps()
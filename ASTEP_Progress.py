@@ -0,0 +1,130 @@
+import numpy as np
+import signal
+import time
+
+"""
+This function reports progress and handles cancellation for long A-STEP DEE runs.
+
+Steps
+    1: Define reporting parameters
+    2: Start a task with its total number of units and, optionally, its total number of bytes
+    3: Update the task from inside its loop, printing the rate, bytes parsed, and estimated
+       time remaining at most once every report interval
+    4: Finish the task, printing its total time and throughput
+
+One ASTEP_Progress is shared by a run through ARC.progress. After install_signal_handlers,
+SIGINT and SIGTERM set the cancelled flag, and the next update of a cancellable task raises
+ASTEP_Cancelled so that the run can stop between outputs. A second signal interrupts the
+run immediately.
+
+"""
+
+class ASTEP_Cancelled(Exception):
+    pass
+
+
+class ASTEP_Progress:
+    def __init__(self,interval = 5):
+        self.interval  = interval # s between progress lines
+        self.cancelled = False
+        self.signum    = None
+
+        self.task = None
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGINT,self.handle_signal)
+        signal.signal(signal.SIGTERM,self.handle_signal)
+
+    def handle_signal(self,signum,frame):
+        if self.cancelled:
+            raise KeyboardInterrupt
+        self.cancelled = True
+        self.signum = signum
+        print(f'Received {signal.Signals(signum).name}, stopping at the next progress check; outputs already written are kept, '
+              f'the current step is discarded (send again to stop immediately)')
+
+    def check(self):
+        if self.cancelled:
+            raise ASTEP_Cancelled(f'Cancelled by {signal.Signals(self.signum).name} during {self.task}')
+
+    def start(self,task,total = None,unit = 'events',total_bytes = None,cancellable = True):
+        self.task        = task
+        self.total       = total
+        self.unit        = unit
+        self.total_bytes = total_bytes
+        self.cancellable = cancellable
+
+        self.done    = 0
+        self.n_bytes = 0
+        self.start_time  = time.monotonic()
+        self.last_report = self.start_time
+
+        if self.cancellable:
+            self.check()
+
+    def update(self,done,n_bytes = None,extra = ''):
+        self.done = done
+        if n_bytes is not None:
+            self.n_bytes = n_bytes
+
+        if self.cancellable:
+            self.check()
+
+        now = time.monotonic()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report(now,extra)
+
+    def format_time(self,seconds):
+        seconds = int(seconds)
+        return f'{seconds//3600}:{(seconds//60)%60:02d}:{seconds%60:02d}'
+
+    def report(self,now,extra = ''):
+        elapsed = now - self.start_time
+        rate = self.done/elapsed if elapsed > 0 else 0
+
+        # Estimate the fraction complete from bytes if known, since unit totals are often not
+        if self.total_bytes:
+            fraction = self.n_bytes/self.total_bytes
+        elif self.total:
+            fraction = self.done/self.total
+        else:
+            fraction = None
+
+        line = f'[{self.task}] {self.done}'
+        if self.total:
+            line += f'/{self.total}'
+        line += f' {self.unit}'
+        if fraction is not None:
+            line += f' ({100*fraction:.1f}%)'
+        line += f' | {rate:.1f} {self.unit}/s'
+        if self.total_bytes:
+            line += f' | {self.n_bytes/1e6:.1f}/{self.total_bytes/1e6:.1f} MB'
+        elif self.n_bytes:
+            line += f' | {self.n_bytes/1e6:.1f} MB'
+        if fraction:
+            line += f' | ETA {self.format_time(elapsed*(1 - fraction)/fraction)}'
+        if extra != '':
+            line += ' | ' + extra
+        print(line)
+
+    def finish(self,done = None):
+        if done is not None:
+            self.done = done
+        elapsed = time.monotonic() - self.start_time
+        rate = self.done/elapsed if elapsed > 0 else 0
+
+        line = f'[{self.task}] done: {self.done} {self.unit} in {self.format_time(elapsed)} ({rate:.1f} {self.unit}/s'
+        if self.n_bytes:
+            line += f', {self.n_bytes/1e6/elapsed if elapsed > 0 else 0:.1f} MB/s'
+        print(line + ')')
+
+    def passes_remaining(self,n_coins):
+
+        # Estimates the coincidence passes left from the counts of coincidences at the start of
+        # each pass so far, assuming the count keeps falling by the same factor per pass
+
+        if len(n_coins) < 2 or n_coins[-1] >= n_coins[-2] or n_coins[-1] == 0:
+            return None
+        ratio = n_coins[-1]/n_coins[-2]
+        return int(np.ceil(np.log(n_coins[-1])/-np.log(ratio))) + 1
@@ -1,5 +1,10 @@
 import numpy as np
 import h5py as h5
+import json
+import os
+import shutil
+
+from ASTEP_Progress import ASTEP_Progress
 
 """
 This function applies the reverse calibration to A-STEP simulations.
@@ -16,14 +21,17 @@ Steps
 """
 
 class ASTEP_RevCal:
-    def __init__(self,sim_name,calib_name,is_h5,seed):
+    def __init__(self,sim_name,calib_name,is_h5,seed,is_cols=False):
         self.sim_name   = sim_name
         self.calib_name = calib_name
         self.is_h5      = is_h5
+        self.is_cols    = is_cols
         self.seed       = seed
         
         if is_h5:
             self.out_name = sim_name + '.ASTEP.h5'
+        elif is_cols:
+            self.out_name = sim_name + '.ASTEP.cols'
         else:
             self.out_name = sim_name + '.ASTEP.csv'
         
@@ -65,6 +73,11 @@ class ASTEP_RevCal:
         self.FPGA_diff_cutoff = 1e6
         
         self.FPGA_readout_cycles = 42
+        
+        self.out_header = 'dec_ord,readout,layer,chipID,payload,location,isCol,timestamp,tot_msb,tot_lsb,tot_total,tot_us,fpga_ts'
+        
+        self.progress = ASTEP_Progress()
+        self.progress_stride = 10000 # loop iterations between progress updates
     
     def clean_FPGA_times(self,array):
     
@@ -106,10 +119,18 @@ class ASTEP_RevCal:
         return edit_array
     
     def read_sim(self):
+        self.progress.start('read_sim',total_bytes = os.path.getsize(self.sim_name))
+        n_events = 0
+        n_bytes = 0
+        
         TKR_hits = []
-        for line in open(self.sim_name,'r'):
+        for n_lines,line in enumerate(open(self.sim_name,'r')):
+            n_bytes += len(line)
+            if n_lines % self.progress_stride == 0:
+                self.progress.update(n_events,n_bytes)
             if 'ID' == line[:2]:
                 eid = float(line.split()[1])
+                n_events += 1
             if 'TI' == line[:2]:
                 time = float(line.split()[1])
             if 'HTsim 1' == line[:7]:
@@ -120,6 +141,7 @@ class ASTEP_RevCal:
                 e = float(split_line[4])
                 TKR_hits.append([eid,time,x,y,z,e])
         self.TKR_hits = np.array(TKR_hits)
+        self.progress.finish(n_events)
     
     def pinpoint(self):
         # A-STEP is flat in the zx plane
@@ -161,6 +183,9 @@ class ASTEP_RevCal:
         calib_f = h5.File(self.calib_name,'r')
         calib_layers = calib_f.keys()
         
+        self.progress.start('RevCal',total = len(self.TKR_hits),unit = 'hits')
+        n_hits = 0
+        
         if self.seed >= 0:
             rng = np.random.default_rng(seed = self.seed)
         else:
@@ -191,6 +216,7 @@ class ASTEP_RevCal:
                     thresh_array[:,:2] = calib_array[:,:2]
         
                 cond1 = (self.Layer_IDs == layer) & (self.Chip_IDs == chip)
+                n_hits_chip = 0
                 
                 for i in range(len(calib_array)):
                     i_row = calib_array[i,0]
@@ -210,7 +236,14 @@ class ASTEP_RevCal:
                     subthresh_row[cond] = ToT_us_row_smear[cond] > thresh_array[i,2]
                     subthresh_col[cond] = ToT_us_col_smear[cond] > thresh_array[i,2]
                     
+                    n_hits_chip += np.count_nonzero(cond)
+                    self.progress.update(n_hits + n_hits_chip)
+                
+                # Count every hit on this chip, including those on pixels missing from the calibration
+                n_hits += np.count_nonzero(cond1)
+                    
         calib_f.close()
+        self.progress.finish(len(self.TKR_hits))
         
         ToT_us_row_smear = ((ToT_us_row_smear*100)//1)/100
         ToT_tot_row = (ToT_us_row_smear / 1e6 * self.AstroPix_ToT_Clock_Freq).astype(int) # should be in AstroPix ToT clock units
@@ -238,7 +271,6 @@ class ASTEP_RevCal:
         self.FPGA_col_times = (((self.TKR_hits[:,1] + 1e-6*self.ToT_us_col + self.FPGA_Clock_Offset)*self.FPGA_Clock_Freq)%self.FPGA_Max_Clock).astype(int)
         
     def make_out_array(self):
-        self.out_header = 'dec_ord,readout,layer,chipID,payload,location,isCol,timestamp,tot_msb,tot_lsb,tot_total,tot_us,fpga_ts'
         out_array = np.zeros([2*len(self.TKR_hits),13])
         out_subthresh = np.zeros(2*len(self.TKR_hits))
         
@@ -246,7 +278,10 @@ class ASTEP_RevCal:
         out_array[:,0] = np.zeros(2*len(self.TKR_hits)) # dec_ord
         out_array[:,4] = 4*np.ones(2*len(self.TKR_hits)) # payload
         
+        self.progress.start('make_out_array',total = len(self.TKR_hits),unit = 'hits')
         for i in range(len(self.TKR_hits)):
+            if i % self.progress_stride == 0:
+                self.progress.update(i)
             
             # dec_ord already done
             
@@ -300,32 +335,109 @@ class ASTEP_RevCal:
             out_subthresh[2*i  ] = self.subthresh_row[i]
             out_subthresh[2*i+1] = self.subthresh_col[i]
             
+        self.progress.finish(len(self.TKR_hits))
+            
         # Remove sub-threshold hits
         out_array = out_array[out_subthresh == 1]
         
         self.out_array = out_array.copy()
         
-    def write_output(self):
+    def column_dtype(self,col):
+        # On-disk dtype of a column in the columnar output
+        if col == 'tot_us':
+            return np.dtype('<f8')
+        else:
+            return np.dtype('<i8')
+    
+    def write_columnar(self,out_name,array,final_name = ''):
+    
+        # Writes one raw little-endian binary file per column into the directory out_name, plus a
+        # header.json holding the column names, dtypes, and row count. A single column can then be
+        # loaded without reading the rest, e.g.
+        #   header = json.load(open(out_name + '/header.json'))
+        #   fpga_ts = np.memmap(out_name + '/fpga_ts.bin', dtype = header['dtypes']['fpga_ts'], mode = 'r', shape = (header['n_rows'],))
+        # With no rows the .bin files are empty and np.memmap raises, so consumers must check
+        # header['n_rows'] == 0 first.
+        
+        os.makedirs(out_name,exist_ok = True)
+        columns = self.out_header.split(',')
+        
+        # final_name labels the progress lines when out_name is a temporary name from write_atomic
+        self.progress.start('write ' + os.path.basename(final_name or out_name),total = len(columns),unit = 'columns',cancellable = False)
+        n_bytes = 0
+        
+        dtypes = {}
+        for i,col in enumerate(columns):
+            dtype = self.column_dtype(col)
+            dtypes[col] = dtype.str
+            np.ascontiguousarray(array[:,i],dtype = dtype).tofile(os.path.join(out_name,col + '.bin'))
+            n_bytes += len(array)*dtype.itemsize
+            self.progress.update(i+1,n_bytes)
+        
+        header = {'columns': columns, 'dtypes': dtypes, 'n_rows': int(len(array))}
+        with open(os.path.join(out_name,'header.json'),'w') as header_file:
+            json.dump(header,header_file,indent = 4)
+        
+        self.progress.finish(len(columns))
+    
+    def write_atomic(self,out_name,write_file):
+    
+        # Writes out_name through write_file(part_name) to a temporary name and then moves it into
+        # place, so that an interrupted run never leaves a partially written output under out_name
+        
+        part_name = out_name + '.part'
+        try:
+            write_file(part_name)
+        except BaseException:
+            if os.path.isdir(part_name):
+                shutil.rmtree(part_name)
+            elif os.path.exists(part_name):
+                os.remove(part_name)
+            raise
+        
+        if os.path.isdir(out_name):
+            shutil.rmtree(out_name)
+        os.replace(part_name,out_name)
+    
+    def write_csv(self,out_name,array,final_name = ''):
+        # Writers are not cancellable: a finished stage's output is always written in full
+        self.progress.start('write ' + os.path.basename(final_name or out_name),total = len(array),unit = 'rows',cancellable = False)
+        n_bytes = 0
+        
+        out_file = open(out_name,'w')
+        out_file.write(self.out_header + '\n')
+        for j,row in enumerate(array):
+            string = ""
+            for i,el in enumerate(row):
+                if i == 11:
+                    string = string + f'{el:.2f},'
+                elif i == 12:
+                    string = string + f'{int(el)}\n'
+                else:
+                    string = string + f'{int(el)},'
+            out_file.write(string)
+            n_bytes += len(string)
+            if j % self.progress_stride == 0:
+                self.progress.update(j,n_bytes)
+        out_file.close()
+        
+        self.progress.finish(len(array))
+    
+    def write_file(self,out_name):
         if self.is_h5:
-            out_file = h5.File(self.out_name,'w')
+            out_file = h5.File(out_name,'w')
             out_file.create_dataset('Data',data = self.out_array)
             out_file.create_dataset('Column_Names',data = self.out_header.split(','))
             out_file.close()
         
+        elif self.is_cols:
+            self.write_columnar(out_name,self.out_array,self.out_name)
+        
         else:
-            out_file = open(self.out_name,'w')
-            out_file.write(self.out_header + '\n')
-            for row in self.out_array:
-                string = ""
-                for i,el in enumerate(row):
-                    if i == 11:
-                        string = string + f'{el:.2f},'
-                    elif i == 12:
-                        string = string + f'{int(el)}\n'
-                    else:
-                        string = string + f'{int(el)},'
-                out_file.write(string)
-            out_file.close()
+            self.write_csv(out_name,self.out_array,self.out_name)
+    
+    def write_output(self):
+        self.write_atomic(self.out_name,self.write_file)
     
     def process(self):
         self.read_sim()
@@ -0,0 +1,389 @@
+import numpy as np
+import h5py as h5
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from ASTEP_RevCal import ASTEP_RevCal
+from ASTEP_Add_BG import ASTEP_Add_BG
+from ASTEP_Effects import ASTEP_Effects
+
+"""
+This script checks the A-STEP DEE against a recorded golden output.
+
+The usage is
+>> ASTEP_Validate.py <record/check> <golden .h5 file name> <Calibration & Resolution file name>
+<optional --seed flag followed by a seed number> <optional --n_events flag followed by a number of events>
+<optional --threshold flag followed by the allowed fractional throughput drop>
+<optional --repeats flag followed by the number of timed runs>
+
+Steps
+    1: Write a seeded synthetic .sim file and two seeded synthetic .csv background files, one
+       much shorter than the source
+    2: Run ASTEP_RevCal, ASTEP_Add_BG, and ASTEP_Effects on these inputs, and ASTEP_Add_BG again
+       with the short background looped (--loop_BG)
+    3: Write each stage's output as .csv, .h5, and .cols and read the results back
+    4: Fingerprint every intermediate array and record the stage throughputs
+    5: Either record these to the golden file or compare them against it
+
+When checking, every array must match the golden array exactly. Any mismatch reports the
+columns and rows that differ. The check also fails if the total throughput drops by more than
+--threshold relative to the recorded throughput. Throughputs are machine-dependent, so the
+golden file should be recorded on the machine it is checked on.
+
+"""
+
+class ASTEP_Validate:
+    def __init__(self,golden_name,calib_name,seed,n_events,threshold,repeats):
+        self.golden_name = golden_name
+        self.calib_name  = calib_name
+        self.seed        = seed
+        self.n_events    = n_events
+        self.threshold   = threshold
+        self.repeats     = repeats
+
+        self.Event_Rate = 2000 # Hz, high enough that the coincidence handling is exercised
+        self.Max_Hits_Per_Event = 3
+        self.E_min = 10 # keV
+        self.E_max = 500 # keV
+
+        self.Loop_Chunk_Size = 64 # BG store rows per chunk in the looped Add_BG stage
+        self.Loop_Block_Size = 32 # BG store rows per index block in the looped Add_BG stage
+
+        self.stages = ['RevCal','Add_BG','Effects','Write','Add_BG_loop']
+
+    def make_inputs(self,tmp_dir):
+        rng = np.random.default_rng(seed = self.seed)
+
+        # Geometry comes from ASTEP_RevCal so that the synthetic hits land on pixel centers
+        ARC = ASTEP_RevCal('',self.calib_name,False,self.seed)
+        calib_f = h5.File(self.calib_name,'r')
+        n_layers = len(calib_f.keys())
+        calib_f.close()
+
+        self.sim_name = os.path.join(tmp_dir,'ASTEP_Validate.sim')
+        sim_file = open(self.sim_name,'w')
+        sim_file.write('Type SIM\nVersion 25\nGeometry ASTEP_Validate\n\nTB 0\n\n')
+
+        event_time = 0
+        for eid in range(1,self.n_events+1):
+            event_time += rng.exponential(1/self.Event_Rate)
+            sim_file.write('SE\n')
+            sim_file.write(f'ID {eid} {eid}\n')
+            sim_file.write(f'TI {event_time:.9f}\n')
+            for hit in range(rng.integers(1,self.Max_Hits_Per_Event+1)):
+                layer  = rng.integers(0,n_layers)
+                chip_x = rng.integers(0,ARC.N_Chip_Xs)
+                chip_z = rng.integers(0,ARC.N_Chip_Zs)
+                row    = rng.integers(0,ARC.N_pixel_Xs)
+                col    = rng.integers(0,ARC.N_pixel_Zs)
+
+                x = ARC.x0 + chip_x*ARC.Chip_Spacing_X + row*ARC.pixel_size_X
+                y = ARC.Layer_Offset_Y + layer*ARC.Layer_Spacing_Y
+                z = ARC.z0 + chip_z*ARC.Chip_Spacing_Z + col*ARC.pixel_size_Z
+                e = rng.uniform(self.E_min,self.E_max)
+                sim_file.write(f'HTsim 1;{x:.5f};{y:.5f};{z:.5f};{e:.5f};{event_time:.9f}\n')
+        sim_file.write('EN\n')
+        sim_file.close()
+
+        # Background in the quad chip decoder format, one row & one column entry per hit
+        self.BG_name = os.path.join(tmp_dir,'ASTEP_Validate_BG.csv')
+        self.write_BG(ARC,rng,self.BG_name,self.n_events,rng.integers(0,ARC.FPGA_Max_Clock),n_layers)
+
+        # A background much shorter than the source for the looped Add_BG stage, starting just
+        # before an FPGA clock rollover so that the store's rollover unwrapping is exercised
+        n_short_events = max(self.n_events//10,2)
+        mean_gap = ARC.FPGA_Clock_Freq/self.Event_Rate + ARC.FPGA_readout_cycles/2
+        self.short_BG_name = os.path.join(tmp_dir,'ASTEP_Validate_BG_short.csv')
+        self.write_BG(ARC,rng,self.short_BG_name,n_short_events,int(ARC.FPGA_Max_Clock - mean_gap*n_short_events/2),n_layers)
+
+    def write_BG(self,ARC,rng,BG_name,n_events,FPGA_time,n_layers):
+        BG_file = open(BG_name,'w')
+        BG_file.write(ARC.out_header + '\n')
+
+        for i in range(n_events):
+            FPGA_time += int(rng.exponential(ARC.FPGA_Clock_Freq/self.Event_Rate)) + 1
+            layer = rng.integers(0,n_layers)
+            chip  = rng.integers(0,ARC.N_Chip_Xs*ARC.N_Chip_Zs)
+            stamp = rng.integers(0,ARC.AstroPix_Max_Clock)
+            for is_col in ['False','True']:
+                location = rng.integers(0,ARC.N_pixel_Xs)
+                ToT_tot  = rng.integers(0,ARC.AstroPix_ToT_Max_Clock)
+                ToT_us   = ToT_tot*1e6/ARC.AstroPix_ToT_Clock_Freq
+                BG_file.write(f'0,0,{layer},{chip},4,{location},{is_col},{stamp},{ToT_tot >> 8},{ToT_tot % 2**8},'
+                              f'{ToT_tot},{ToT_us:.2f},{FPGA_time % ARC.FPGA_Max_Clock}\n')
+                FPGA_time += rng.integers(0,ARC.FPGA_readout_cycles)
+        BG_file.close()
+
+    def read_back(self,out_name):
+        # Reads an output back into an array, checking the .cols header against the data
+        if out_name.endswith('.h5'):
+            in_file = h5.File(out_name,'r')
+            array = in_file['Data'][...]
+            in_file.close()
+        elif out_name.endswith('.cols'):
+            with open(os.path.join(out_name,'header.json'),'r') as header_file:
+                header = json.load(header_file)
+            if header['columns'] != self.out_header.split(','):
+                raise ValueError(f'{out_name}: header columns {header["columns"]} != {self.out_header.split(",")}')
+            array = np.column_stack([np.fromfile(os.path.join(out_name,col + '.bin'),dtype = header['dtypes'][col])
+                                     for col in header['columns']])
+            if header['n_rows'] != len(array):
+                raise ValueError(f'{out_name}: header n_rows {header["n_rows"]} != {len(array)} rows on disk')
+        else:
+            array = np.loadtxt(out_name,delimiter = ',',skiprows = 1,ndmin = 2)
+        return array
+
+    def write_all(self,stage,suffix,name,arrays):
+        # Writes a stage's output in each format and reads it back, so that formatting changes are
+        # caught too
+        write_time = 0
+        for out_format,is_h5,is_cols in [('csv',False,False),('h5',True,False),('cols',False,True)]:
+            stage.is_h5 = is_h5
+            stage.is_cols = is_cols
+            stage.out_name = self.sim_name + suffix + '.' + out_format
+
+            t0 = time.perf_counter()
+            stage.write_output()
+            write_time += time.perf_counter() - t0
+
+            arrays[f'{name}_written_{out_format}'] = self.read_back(stage.out_name)
+        return write_time
+
+    def run_pipeline(self):
+        arrays = {}
+        times = {}
+
+        t0 = time.perf_counter()
+        ARC = ASTEP_RevCal(self.sim_name,self.calib_name,False,self.seed)
+        ARC.read_sim()
+        ARC.pinpoint()
+        ARC.RevCal()
+        ARC.get_clock_times()
+        ARC.make_out_array()
+        times['RevCal'] = time.perf_counter() - t0
+
+        arrays['TKR_hits']   = ARC.TKR_hits.copy()
+        arrays['Layer_IDs']  = ARC.Layer_IDs.copy()
+        arrays['Chip_IDs']   = ARC.Chip_IDs.copy()
+        arrays['rows']       = ARC.rows.copy()
+        arrays['cols']       = ARC.cols.copy()
+        arrays['ToT_tot_row'] = ARC.ToT_tot_row.copy()
+        arrays['ToT_tot_col'] = ARC.ToT_tot_col.copy()
+        arrays['FPGA_row_times'] = ARC.FPGA_row_times.copy()
+        arrays['FPGA_col_times'] = ARC.FPGA_col_times.copy()
+        arrays['RevCal_out_array'] = ARC.out_array.copy()
+
+        # Written straight away, as in DEE.py, since ASTEP_Add_BG modifies ARC.out_array
+        self.out_header = ARC.out_header
+        times['Write'] = self.write_all(ARC,'.ASTEP','RevCal',arrays)
+
+        t0 = time.perf_counter()
+        ABG = ASTEP_Add_BG(ARC,self.BG_name,False)
+        ABG.read_BG()
+        ABG.sort_FPGA_times()
+        ABG.combine_arrays()
+        times['Add_BG'] = time.perf_counter() - t0
+
+        arrays['BG_array'] = ABG.BG_array.copy()
+        arrays['combined_array_sorted'] = ABG.combined_array_sorted.copy()
+        times['Write'] += self.write_all(ABG,'.ASTEP_wBG','Add_BG',arrays)
+
+        t0 = time.perf_counter()
+        AE = ASTEP_Effects(self.sim_name,ABG.combined_array_sorted,False,True,ARC)
+        AE.sort_FPGA_timestamps()
+        # coincidence_hits edits in_FPGA_times in place, so the sorted input is copied first
+        in_FPGA_times = AE.in_FPGA_times.copy()
+        AE.coincidence_hits()
+        times['Effects'] = time.perf_counter() - t0
+
+        arrays['Effects_in_FPGA_times'] = in_FPGA_times
+        arrays['Effects_out_array'] = AE.out_array.copy()
+        arrays['Effects_out_time'] = AE.out_time.copy()
+        times['Write'] += self.write_all(AE,'.ASTEP_wBG_wEff','Effects',arrays)
+
+        # Looped background through ASTEP_BG_Store, from the RevCal output as it was before
+        # ASTEP_Add_BG modified it. The store is rebuilt every run, with small chunks and blocks
+        # so that the cross-chunk rollover carry and the block index are both exercised.
+        ARC.out_array = arrays['RevCal_out_array'].copy()
+        store_name = self.short_BG_name + '.cols'
+        if os.path.exists(store_name):
+            shutil.rmtree(store_name)
+
+        t0 = time.perf_counter()
+        ABG_loop = ASTEP_Add_BG(ARC,self.short_BG_name,False,False,True,store_name)
+        ABG_loop.BG_store.chunk_size = self.Loop_Chunk_Size
+        ABG_loop.BG_store.block_size = self.Loop_Block_Size
+        ABG_loop.read_BG()
+        ABG_loop.sort_FPGA_times()
+        ABG_loop.combine_arrays()
+        times['Add_BG_loop'] = time.perf_counter() - t0
+
+        arrays['Add_BG_loop_BG_array'] = ABG_loop.BG_array.copy()
+        arrays['Add_BG_loop_BG_FPGA_times_corrected'] = ABG_loop.BG_FPGA_times_corrected.copy()
+        arrays['Add_BG_loop_combined_array_sorted'] = ABG_loop.combined_array_sorted.copy()
+
+        return arrays, times
+
+    def fingerprint(self,array):
+        array = np.ascontiguousarray(array)
+        digest = hashlib.sha256()
+        digest.update(str(array.dtype).encode())
+        digest.update(str(array.shape).encode())
+        digest.update(array.tobytes())
+        return digest.hexdigest()
+
+    def column_names(self,name,array):
+        if array.ndim == 2 and array.shape[1] == len(self.out_header.split(',')):
+            return self.out_header.split(',')
+        elif name == 'TKR_hits':
+            return ['eid','time','x','y','z','e']
+        elif array.ndim == 2:
+            return [str(i) for i in range(array.shape[1])]
+        else:
+            return [name]
+
+    def compare(self,name,golden,array):
+        # Describes where array differs from golden, row by row and column by column
+        messages = []
+        if golden.shape != array.shape:
+            messages.append(f'{name}: shape {array.shape} != golden shape {golden.shape}')
+
+        n_rows = min(len(golden),len(array))
+        golden_2d = golden[:n_rows].reshape(n_rows,-1)
+        array_2d  = array[:n_rows].reshape(n_rows,-1)
+        if golden_2d.shape[1] != array_2d.shape[1]:
+            return messages
+
+        differs = (golden_2d != array_2d) & ~(np.isnan(golden_2d.astype(float)) & np.isnan(array_2d.astype(float)))
+        columns = self.column_names(name,array)
+        for i in np.where(differs.any(axis = 0))[0]:
+            bad_rows = np.where(differs[:,i])[0]
+            shown = ', '.join(f'{row} ({golden_2d[row,i]} -> {array_2d[row,i]})' for row in bad_rows[:10])
+            more = f', ... {len(bad_rows) - 10} more' if len(bad_rows) > 10 else ''
+            messages.append(f'{name}: column {columns[i]} differs in {len(bad_rows)} rows: {shown}{more}')
+        if len(messages) == 0:
+            messages.append(f'{name}: fingerprint differs but no element-wise difference found (dtype {golden.dtype} -> {array.dtype})')
+        return messages
+
+    def run(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self.make_inputs(tmp_dir)
+            arrays, best_times = self.run_pipeline()
+            for i in range(self.repeats - 1):
+                _, times = self.run_pipeline()
+                for stage in self.stages:
+                    best_times[stage] = min(best_times[stage],times[stage])
+
+        self.arrays = arrays
+        self.throughputs = {stage: self.n_events/best_times[stage] for stage in self.stages}
+        self.throughputs['Total'] = self.n_events/sum(best_times.values())
+
+        for stage,throughput in self.throughputs.items():
+            print(f'{stage:>8}: {throughput:.1f} events/s')
+
+    def record(self):
+        golden_f = h5.File(self.golden_name,'w')
+        golden_f.attrs['seed'] = self.seed
+        golden_f.attrs['n_events'] = self.n_events
+        golden_f.attrs['out_header'] = self.out_header
+        for stage,throughput in self.throughputs.items():
+            golden_f.attrs['throughput_' + stage] = throughput
+        for name,array in self.arrays.items():
+            dset = golden_f.create_dataset(name,data = array)
+            dset.attrs['sha256'] = self.fingerprint(array)
+        golden_f.close()
+        print(f'Golden output recorded to {self.golden_name}')
+        return True
+
+    def check(self):
+        golden_f = h5.File(self.golden_name,'r')
+        passed = True
+
+        for name in golden_f.keys():
+            if name not in self.arrays:
+                print(f'FAIL {name}: missing from this run')
+                passed = False
+                continue
+            if self.fingerprint(self.arrays[name]) == golden_f[name].attrs['sha256']:
+                print(f'  OK {name}')
+                continue
+            passed = False
+            print(f'FAIL {name}')
+            for message in self.compare(name,golden_f[name][...],self.arrays[name]):
+                print('     ' + message)
+        for name in self.arrays:
+            if name not in golden_f:
+                print(f'  -- {name}: not in golden file, not checked')
+
+        # The total is compared over the stages the golden file recorded, so that a golden file
+        # from before a stage was added to the harness is still a fair comparison
+        golden_throughput = golden_f.attrs['throughput_Total']
+        recorded_stages = [stage for stage in self.stages if 'throughput_' + stage in golden_f.attrs]
+        golden_f.close()
+        throughput = self.n_events/sum(self.n_events/self.throughputs[stage] for stage in recorded_stages)
+
+        floor = (1 - self.threshold)*golden_throughput
+        if throughput < floor:
+            print(f'FAIL throughput: {throughput:.1f} events/s < {floor:.1f} events/s '
+                  f'({golden_throughput:.1f} events/s recorded, threshold {self.threshold})')
+            passed = False
+        else:
+            print(f'  OK throughput: {throughput:.1f} events/s (recorded {golden_throughput:.1f} events/s)')
+
+        return passed
+
+    def process(self,mode):
+        if mode == 'check':
+            # Regenerate the inputs the golden file was recorded with
+            golden_f = h5.File(self.golden_name,'r')
+            self.seed = int(golden_f.attrs['seed'])
+            self.n_events = int(golden_f.attrs['n_events'])
+            golden_f.close()
+
+        self.run()
+        if mode == 'record':
+            return self.record()
+        else:
+            return self.check()
+
+
+def parseargs():
+
+    """
+    This function handles getting arguments when this function is called
+
+    input 1: record or check
+    input 2: path to the golden output file
+    input 3: path to the TKR calibration file
+
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode", choices = ['record','check'], help = "Record a new golden output or check against one")
+    parser.add_argument("golden_filename", help = "Path to the golden output .h5 file")
+    parser.add_argument("TKR_calib_filename", help = "Path to tracker calibration & resolution file")
+    parser.add_argument("--seed", default = 0, help = "Seed for the synthetic inputs and smearing (record only)")
+    parser.add_argument("--n_events", default = 2000, help = "Number of synthetic events (record only)")
+    parser.add_argument("--threshold", default = 0.2, help = "Allowed fractional drop in total throughput")
+    parser.add_argument("--repeats", default = 3, help = "Number of timed runs; the fastest is used")
+    args = parser.parse_args()
+    return args
+
+
+def cli():
+
+    args = parseargs()
+    AV = ASTEP_Validate(args.golden_filename,args.TKR_calib_filename,int(args.seed),int(args.n_events),
+                        float(args.threshold),int(args.repeats))
+    passed = AV.process(args.mode)
+    if not passed:
+        sys.exit(1)
+
+
+if  __name__ == '__main__': cli()
@@ -2,18 +2,21 @@
 import numpy as np
 import h5py as h5
 import argparse
+import sys
 
 from ASTEP_RevCal import ASTEP_RevCal
 from ASTEP_Add_BG import ASTEP_Add_BG
 from ASTEP_Effects import ASTEP_Effects
+from ASTEP_Progress import ASTEP_Cancelled
 
 """
 
 This script executes an A-STEP detector effects engine.
 
 The usage is 
->> DEE.py <.sim file name> <Calibration & Resolution file name> <optional -h5 flag> 
+>> DEE.py <.sim file name> <Calibration & Resolution file name> <optional -h5 or -cols flag> 
 <optional --ASTEP_BG_filename flag followed by the path to a csv ASTEP background data>
+<optional --loop_BG flag> <optional --BG_store flag followed by a path for the indexed background store>
 <optional --seed flag followed by a seed number for smearing>
 
 The .sim file name is a Cosima-generated simulation file, where the detectors lie in the xz plane.
@@ -58,10 +61,23 @@ The calibration and resolution arrays' formats are both Row # | Column # | Slope
     
 Including the -h5 flag forces the output of the RevCal step to be an h5 file. Otherwise, it writes to a csv.
 
+Including the -cols flag instead writes each output as a directory of per-column raw binary arrays
+(<column>.bin) with a header.json giving the column names, dtypes, and row count. Individual columns
+can be read with np.memmap without loading the rest of the output.
+
 Including the --ASTEP_BG_filename flag needs an accompanying path to a .csv file with ASTEP data. 
 If given, this script combines the post-reverse calibration simulated data with this dataset, truncating
 at the earlier of the ends of each dataset.
 
+Including the --loop_BG flag instead loops the background end to end so that the whole simulation is kept.
+The background is then read through a time-indexed store, written next to the .csv file unless the
+--BG_store flag gives another path (e.g. when the background's directory is read-only).
+
+Progress, throughput, and estimated time remaining are printed during each long step. On SIGINT or SIGTERM,
+the run stops at the next progress check, keeps every output already written, and exits with 128 + the
+signal number. Outputs are written to a .part name and moved into place when complete, so an interrupted
+run never leaves a partially written output.
+
 Including the --seed flag provides a seed for the random number generator in ASTEP_RevCal that is used for smearing
 
 """
@@ -80,7 +96,11 @@ def parseargs():
     parser.add_argument("sim_filename", help = "Path to *.sim file from Cosima")
     parser.add_argument("TKR_calib_filename", help = "Path to tracker calibration & resolution file")
     parser.add_argument("--ASTEP_BG_filename", default = '', help = "Empirical A-STEP Background File")
-    parser.add_argument("-h5", action = 'store_true', help = "Write outputs as h5?")
+    out_format = parser.add_mutually_exclusive_group()
+    out_format.add_argument("-h5", action = 'store_true', help = "Write outputs as h5?")
+    out_format.add_argument("-cols", action = 'store_true', help = "Write outputs as a directory of per-column binary arrays?")
+    parser.add_argument("--loop_BG", action = 'store_true', help = "Loop the background to cover the whole simulation instead of truncating it?")
+    parser.add_argument("--BG_store", default = '', help = "Where to keep the indexed background store used by --loop_BG (default <background file>.cols)")
     parser.add_argument("--seed", default = -1, help = "Seed for random number generation during smearing")
     args = parser.parse_args()
     return args
@@ -93,28 +113,43 @@ def cli():
     TKR_calib_filename = args.TKR_calib_filename
     ASTEP_BG_filename = args.ASTEP_BG_filename
     is_h5 = args.h5
+    is_cols = args.cols
+    loop_BG = args.loop_BG
+    BG_store_name = args.BG_store
     seed = int(args.seed)
     
-    ARC = ASTEP_RevCal(sim_filename,TKR_calib_filename,is_h5,seed)
-    ARC.process()
-    print('A-STEP .sim File Processed')
+    ARC = ASTEP_RevCal(sim_filename,TKR_calib_filename,is_h5,seed,is_cols)
+    ARC.progress.install_signal_handlers()
+    completed = []
     
-    if ASTEP_BG_filename != '':
-        ABG = ASTEP_Add_BG(ARC,ASTEP_BG_filename,is_h5)
-        ABG.process()
-        print('A-STEP Background Added')
-        with_BG = True
-    else:
-        print('No A-STEP Background Given')
-        with_BG = False
+    try:
+        ARC.process()
+        completed.append(ARC.out_name)
+        print('A-STEP .sim File Processed')
+        
+        if ASTEP_BG_filename != '':
+            ABG = ASTEP_Add_BG(ARC,ASTEP_BG_filename,is_h5,is_cols,loop_BG,BG_store_name)
+            ABG.process()
+            completed.append(ABG.out_name)
+            print('A-STEP Background Added')
+            with_BG = True
+        else:
+            print('No A-STEP Background Given')
+            with_BG = False
+        
+        if with_BG:
+            AE = ASTEP_Effects(sim_filename,ABG.combined_array_sorted,is_h5,with_BG,ARC,is_cols)
+            AE.process()
+        else:
+            AE = ASTEP_Effects(sim_filename,ARC.out_array,is_h5,with_BG,ARC,is_cols)
+            AE.process()
+        completed.append(AE.out_name)
+        print('A-STEP Instrument Effects Added')
     
-    if with_BG:
-        AE = ASTEP_Effects(sim_filename,ABG.combined_array_sorted,is_h5,with_BG,ARC)
-        AE.process()
-    else:
-        AE = ASTEP_Effects(sim_filename,ARC.out_array,is_h5,with_BG,ARC)
-        AE.process()
-    print('A-STEP Instrument Effects Added')
+    except ASTEP_Cancelled as error:
+        print(error)
+        print('Completed outputs: ' + (', '.join(completed) if len(completed) > 0 else 'none'))
+        sys.exit(128 + ARC.progress.signum)
     
     
 